@@ -8,7 +8,8 @@ The computation job is received (as Python source code) from the MPC App.
 The job does:
     - receive encrypted data from the encryption servers (clients)
     - perform MPC computation
-Each server may receive and spawn multiple jobs, but only one of the same computation ID (otherwise compromise can be expected). Randomization of job names (thus source code file names) is needed.
+Each server may receive and spawn multiple jobs, but only one of the same computation ID (otherwise compromise can be expected).
+Per-job files (e.g. hosts files) get random names. Programs are named by the full SHA-256 of their source code and compile arguments instead, so jobs running the same program share one compilation, while a different program can never pick up another one's bytecode.
 '''
 
 from fastapi import FastAPI, BackgroundTasks
@@ -21,10 +22,13 @@ import asyncio
 import os
 import sys
 from uuid import uuid4 as uuid
-from asyncio import Lock
 import json
 import datetime
-from aiostream.stream import merge
+import hashlib
+import fcntl
+import shutil
+
+from shared_config import load_config, get_origins
 
 
 MAX_NUM_PLAYER = 6
@@ -33,22 +37,32 @@ if os.environ['PORT_BASE']:
     PORT_BASE = int(os.environ['PORT_BASE'])
 
 
-CONFIG_FILE = 'config/computation_agent.json'
-with open(CONFIG_FILE) as fd:
-    _config = json.load(fd)
+_config = load_config('computation_agent')
 
 BASE_DIR = Path(_config['base_dir'])
+BASE_DIR_STR = str(BASE_DIR)
 OUTPUT_LOG = Path(_config['output_log']).absolute() if 'output_log' in _config else None
 
 PLAYER_CODE_DIR = BASE_DIR / 'Programs/Source/'
+BYTECODE_DIR = BASE_DIR / 'Programs/Bytecode/'
+SCHEDULE_DIR = BASE_DIR / 'Programs/Schedules/'
+COMPILE_LOCK_DIR = BASE_DIR / 'Programs/Locks/'
+COMPILE_LOCK_BUCKETS = 256  # Programs share a fixed set of lock files, so they don't pile up
 HOSTS_DIR = BASE_DIR
 
 PROTOCOL_DIR = BASE_DIR
+# The protocol comes from the request, so only the binaries present at startup are cached
+PROTOCOL_PARTY_PATHS = {p.name[:-len('-party.x')]: str(p) for p in PROTOCOL_DIR.glob('*-party.x')}
 
 os.chdir(BASE_DIR)
+COMPILE_LOCK_DIR.mkdir(exist_ok=True)
 
 DT_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+READ_CHUNK_SIZE = 65536
+OUTPUT_QUEUE_SIZE = 32
+MAX_LINE_SIZE = 1 << 20  # Longer lines are split
+
 
 class PlayerJob(BaseModel):
     computation_id: str
@@ -64,17 +78,9 @@ class PlayerJob(BaseModel):
 
 app = FastAPI()
 
-try:
-    origins = _config['allowed_origins']
-except KeyError:
-    origins = []
-finally:
-    if not origins:
-        origins = ['*']
-
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
+    allow_origins=list(get_origins(_config)),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -82,42 +88,32 @@ app.add_middleware(
 
 
 player_job_pool = {}
-free_ports = [True] * MAX_NUM_PLAYER
-port_lock = Lock()
+output_log_lock = asyncio.Lock()
+compiling = {}
+port_pool = asyncio.Queue(MAX_NUM_PLAYER)
+for i in range(MAX_NUM_PLAYER):
+    port_pool.put_nowait(i)
 
 
 @app.put('/allocate_player')
 async def allocate_player():
     player_place_id = str(uuid())
-    port = -1
-    async with port_lock:
-        for i in range(MAX_NUM_PLAYER):
-            if free_ports[i]:
-                port = PORT_BASE + i
-                player_job_pool[player_place_id] = i
-                free_ports[i] = False
-                print(free_ports)
-                break
-    if port < 0:
+    try:
+        port_index = port_pool.get_nowait()
+    except asyncio.QueueEmpty:
         return 500
-    return {"player_place_id": player_place_id, "port": port}
+    player_job_pool[player_place_id] = port_index
+    return {"player_place_id": player_place_id, "port": PORT_BASE + port_index}
 
 
 @app.put('/player')
-def new_player(player_job: PlayerJob, background_tasks: BackgroundTasks):
+async def new_player(player_job: PlayerJob, background_tasks: BackgroundTasks):
     background_tasks.add_task(save_compile_run_player, player_job)
     return player_job.player_id
 
 
 async def wait_and_handle_output(proc, player_job: PlayerJob, prog_and_args):
-    full_log = b""
-
-    # See https://stackoverflow.com/questions/50901182/watch-stdout-and-stderr-of-a-subprocess-simultaneously
-    async for f in merge(proc.stdout, proc.stderr):
-        sys.stderr.write(f"{datetime.datetime.now()} {f.decode()}")
-        full_log += f
-
-    log = full_log.decode()
+    log_fd = None
     if player_job.player_id == 0 and OUTPUT_LOG:
         s_now = datetime.datetime.now().strftime(DT_FORMAT)
         run_info = {
@@ -127,67 +123,201 @@ async def wait_and_handle_output(proc, player_job: PlayerJob, prog_and_args):
             'num_client': player_job.num_client,
         }
         line_head = f"###### {s_now} {json.dumps(run_info)} ######\n"
-        line_end = "######\n";
-        with open(OUTPUT_LOG, 'a') as fd:
-            fd.write(line_head)
-            fd.write(log)
-            fd.write(line_end)
+        # Collect this job's block separately, so concurrent jobs don't interleave in the log
+        log_fd = await asyncio.to_thread(tempfile.TemporaryFile, dir=OUTPUT_LOG.parent)
+        await asyncio.to_thread(log_fd.write, line_head.encode())
+
+    # Watch stdout and stderr of the subprocess simultaneously, streaming the output to the log
+    chunks = asyncio.Queue(OUTPUT_QUEUE_SIZE)
+
+    async def _pump(stream):
+        # Only whole lines are queued, so lines of stdout and stderr don't get mixed up
+        pending = bytearray()
+        try:
+            while f := await stream.read(READ_CHUNK_SIZE):
+                pending.extend(f)
+                end = pending.rfind(b'\n') + 1
+                if not end and len(pending) >= MAX_LINE_SIZE:
+                    end = len(pending)
+                if end:
+                    await chunks.put(bytes(pending[:end]))
+                    del pending[:end]
+            if pending:
+                await chunks.put(bytes(pending) + b'\n')
+        finally:
+            await chunks.put(None)
+
+    pumps = [asyncio.create_task(_pump(proc.stdout)), asyncio.create_task(_pump(proc.stderr))]
+    num_open = len(pumps)
+    try:
+        while num_open:
+            f = await chunks.get()
+            if f is None:
+                num_open -= 1
+                continue
+            prefix = f"{datetime.datetime.now()} ".encode()
+            sys.stderr.buffer.write(b''.join(prefix + line for line in f.splitlines(keepends=True)))
+            sys.stderr.buffer.flush()
+            if log_fd:
+                try:
+                    await asyncio.to_thread(log_fd.write, f)
+                except OSError as e:
+                    # Keep draining the pipes so the player isn't blocked, but give up on the log
+                    print(f"Failed to write the output log, discarding it: {e!r}", file=sys.stderr)
+                    await asyncio.to_thread(log_fd.close)
+                    log_fd = None
+        await asyncio.gather(*pumps)
+    except BaseException:
+        # Stop the player and discard the rest of its output, so it isn't left blocked on full pipes
+        if proc.returncode is None:
+            proc.kill()
+        while num_open:
+            if await chunks.get() is None:
+                num_open -= 1
+        raise
+    finally:
+        for pump in pumps:
+            pump.cancel()
+        if log_fd:
+            line_end = b"######\n"
+            await asyncio.to_thread(log_fd.write, line_end)
+            async with output_log_lock:
+                await asyncio.to_thread(_append_to_output_log, log_fd)
+            await asyncio.to_thread(log_fd.close)
+
+
+def _append_to_output_log(job_log_fd):
+    job_log_fd.seek(0)
+    with open(OUTPUT_LOG, 'ab') as fd:
+        # Other agents may write to the same log
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        shutil.copyfileobj(job_log_fd, fd)
 
 
 async def save_compile_run_player(player_job: PlayerJob):
-    code_file = save_player_code(player_job.player_code)
-    code_name = code_file.stem
-    hosts_file = save_hosts_file(player_job.player_servers)
-    proc_compile, args = await compile_player_code(code_name, player_job)
-    await proc_compile.communicate()
-    prog_and_args = [code_name] + args
-    compiled_code_name = '-'.join(prog_and_args)
-    proc_player = await run_player(compiled_code_name, hosts_file, player_job)
-    await wait_and_handle_output(proc_player, player_job, prog_and_args)
-    await release_port(player_job.player_place_id)
-    clean_workspace(code_file, hosts_file)
-
-
-def save_player_code(player_code: str) -> Path:
-    code_file = tempfile.mktemp(prefix='player_code_', suffix='.mpc', dir=PLAYER_CODE_DIR)
-    with open(code_file, 'w') as fd:
-        fd.write(player_code)
-    return Path(code_file)
-
-
-async def compile_player_code(code_name: str, player_job: PlayerJob):
-    num_client = player_job.num_client
-    data_size = player_job.data_size
-    cmd = ['./compile.py', code_name, num_client, data_size]
-    cmd.extend(player_job.extra_args)
-    cmd = [str(e) for e in cmd]
-    command_text = f"cd {BASE_DIR}; " + ' '.join(cmd)
-    proc = await asyncio.subprocess.create_subprocess_shell(command_text)
-    return proc, cmd[2:]
-
-
-def save_hosts_file(player_servers: List[str]) -> Path:
-    hosts_file = tempfile.mktemp(prefix='HOSTS_', dir=HOSTS_DIR)
-    with open(hosts_file, 'w') as fd:
-        fd.write('\n'.join(player_servers))
-    return Path(hosts_file)
+    code_name = get_code_name(player_job)
+    hosts_file = None
+    try:
+        results = await asyncio.gather(
+                save_hosts_file(player_job.player_servers),
+                ensure_compiled(code_name, player_job),
+                return_exceptions=True)
+        # Keep the hosts file for cleanup even when the compilation failed
+        if not isinstance(results[0], BaseException):
+            hosts_file = results[0]
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        args = results[1]
+        prog_and_args = [code_name] + args
+        compiled_code_name = '-'.join(prog_and_args)
+        proc_player = await run_player(compiled_code_name, hosts_file, player_job)
+        await wait_and_handle_output(proc_player, player_job, prog_and_args)
+    finally:
+        if hosts_file:
+            clean_workspace(hosts_file)
+        release_port(player_job.player_place_id)
+
+
+def get_code_name(player_job: PlayerJob) -> str:
+    # The compiled program only depends on the source code and the compile arguments
+    key_parts = [player_job.player_code, player_job.num_client, player_job.data_size, player_job.extra_args]
+    key = hashlib.sha256(json.dumps(key_parts).encode()).hexdigest()
+    return f"player_code_{key}"
+
+
+def get_compile_args(player_job: PlayerJob) -> List[str]:
+    args = [player_job.num_client, player_job.data_size]
+    args.extend(player_job.extra_args)
+    return [str(e) for e in args]
+
+
+def is_compiled(compiled_code_name: str) -> bool:
+    # A runnable program needs both its schedule and its bytecode
+    bytecode = any(BYTECODE_DIR.glob(f"{compiled_code_name}-*.bc"))
+    return bytecode and (SCHEDULE_DIR / f"{compiled_code_name}.sch").exists()
+
+
+def get_compile_lock_file(compiled_code_name: str) -> Path:
+    digest = hashlib.sha256(compiled_code_name.encode()).digest()
+    return COMPILE_LOCK_DIR / f"compile_{digest[0] % COMPILE_LOCK_BUCKETS:02x}.lock"
+
+
+async def ensure_compiled(code_name: str, player_job: PlayerJob) -> List[str]:
+    args = get_compile_args(player_job)
+    compiled_code_name = '-'.join([code_name] + args)
+    # Concurrent jobs of the same program in this agent wait for a single compilation
+    while compiled_code_name in compiling:
+        await compiling[compiled_code_name].wait()
+    done = compiling[compiled_code_name] = asyncio.Event()
+    try:
+        # Other agents may share the same MP-SPDZ directory, so the check and the compilation
+        # happen under a file lock; nobody reads the outputs while they are being written
+        with open(get_compile_lock_file(compiled_code_name), 'w') as lock_fd:
+            await asyncio.to_thread(fcntl.flock, lock_fd, fcntl.LOCK_EX)
+            try:
+                if not is_compiled(compiled_code_name):
+                    await compile_locked(code_name, args, player_job.player_code)
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+    finally:
+        del compiling[compiled_code_name]
+        done.set()
+    return args
+
+
+async def compile_locked(code_name: str, args: List[str], player_code: str):
+    code_file = await save_player_code(code_name, player_code)
+    try:
+        proc_compile = await compile_player_code(code_name, args)
+        await proc_compile.communicate()
+    finally:
+        try:
+            os.remove(code_file)
+        except FileNotFoundError:
+            pass
+
+
+def _write_temp_file(content: str, **kwargs) -> Path:
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, **kwargs) as fd:
+        fd.write(content)
+    return Path(fd.name)
+
+
+def _write_file_atomic(file_name: Path, content: str) -> Path:
+    temp_file = _write_temp_file(content, prefix=f".{file_name.name}.", dir=file_name.parent)
+    os.replace(temp_file, file_name)
+    return file_name
+
+
+async def save_player_code(code_name: str, player_code: str) -> Path:
+    return await asyncio.to_thread(_write_file_atomic, PLAYER_CODE_DIR / f"{code_name}.mpc", player_code)
+
+
+async def compile_player_code(code_name: str, args: List[str]):
+    cmd = ['./compile.py', code_name] + args
+    proc = await asyncio.subprocess.create_subprocess_exec(*cmd, cwd=BASE_DIR_STR)
+    return proc
+
+
+async def save_hosts_file(player_servers: List[str]) -> Path:
+    return await asyncio.to_thread(_write_temp_file, '\n'.join(player_servers), prefix='HOSTS_', dir=HOSTS_DIR)
 
 
 async def run_player(code_name: str, hosts_file: Path, player_job: PlayerJob):
-    protocol_main = PROTOCOL_DIR / f"{player_job.protocol}-party.x"
-    cmd = [protocol_main, '-N', len(player_job.player_servers), '-ip', str(hosts_file), player_job.player_id, code_name]
-    cmd = [str(e) for e in cmd]
+    protocol = player_job.protocol
+    protocol_main = PROTOCOL_PARTY_PATHS.get(protocol) or str(PROTOCOL_DIR / f"{protocol}-party.x")
+    cmd = [protocol_main, '-N', str(len(player_job.player_servers)), '-ip', str(hosts_file), str(player_job.player_id), code_name]
     print('@@', cmd)
     proc = await asyncio.subprocess.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
     return proc
 
 
-async def release_port(player_place_id: str):
-    async with port_lock:
-        port_index = player_job_pool[player_place_id]
-        free_ports[port_index] = True
+def release_port(player_place_id: str):
+    port_index = player_job_pool.pop(player_place_id, None)
+    if port_index is not None:
+        port_pool.put_nowait(port_index)
 
 
-def clean_workspace(code_file: Path, hosts_file: Path):
-    os.remove(code_file)
+def clean_workspace(hosts_file: Path):
     os.remove(hosts_file)
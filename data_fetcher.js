@@ -1,13 +1,20 @@
 #!/usr/bin/env node
 
-import { argv } from 'process'
-import { writeFileSync } from 'fs'
+// Usage:
+//   ./data_fetcher.js <data_url> <filename>   fetch a single file and exit
+//   ./data_fetcher.js                         run as a worker, reading one JSON job per line
+//                                             ({"id", "uri", "out"}) from stdin and replying
+//                                             with one JSON line ({"id", "ok"}) on stdout
+
+import { argv, stdin, stdout, stderr } from 'process'
+import { Console } from 'console'
+import { createWriteStream } from 'fs'
+import { Readable } from 'stream'
+import { pipeline } from 'stream/promises'
+import { createInterface } from 'readline'
 import { SolidNodeClient } from 'solid-node-client'
 import config from 'config'
 
-const data_url = argv[2];
-const filename = argv[3];
-
 const credential_config = config.get("credential");
 const credential = {
     idp: credential_config['idp'],
@@ -15,14 +22,76 @@ const credential = {
     password: credential_config['password']
 }
 
-async function getDataAuthenticated(data_url, filename) {
+let clientPromise = null;
+
+async function login() {
     const client = new SolidNodeClient();
     const session = await client.login(credential);
-    if ( session.isLoggedIn ) {
+    return session.isLoggedIn ? client : null;
+}
+
+function invalidateSession(session) {
+    // Concurrent jobs may have already replaced the session
+    if (clientPromise === session) {
+        clientPromise = null;
+    }
+}
+
+// Share one login between jobs. Log in again if it failed or the session is no longer accepted (e.g. expired);
+// a 403 means the session is fine but access is denied, so it is returned as is
+async function fetchAuthenticated(data_url) {
+    for (let attempt = 0; attempt < 2; attempt++) {
+        if (clientPromise === null) {
+            clientPromise = login();
+        }
+        const session = clientPromise;
+        const client = await session.catch(() => null);
+        if (client === null) {
+            invalidateSession(session);
+            return null;
+        }
         const response = await client.fetch(data_url);
-        const code = await response.text();
-        writeFileSync(filename, code);
+        if (response.status !== 401) {
+            return response;
+        }
+        invalidateSession(session);
     }
+    return null;
 }
 
-await getDataAuthenticated(data_url, filename);
+async function getDataAuthenticated(data_url, filename) {
+    const response = await fetchAuthenticated(data_url);
+    if ( response && response.ok ) {
+        // Stream the body to the file as it arrives, without decoding it into a string first
+        await pipeline(Readable.from(response.body), createWriteStream(filename));
+        return true;
+    }
+    console.error(`Failed to fetch ${data_url}: ${response ? response.status : 'not logged in'}`);
+    return false;
+}
+
+async function handleJob(line) {
+    let job_id = null;
+    let ok = false;
+    try {
+        const job = JSON.parse(line);
+        job_id = job['id'];
+        ok = await getDataAuthenticated(job['uri'], job['out']);
+    } catch (e) {
+        console.error(e);
+    }
+    stdout.write(JSON.stringify({ id: job_id, ok: ok }) + '\n');
+}
+
+if (argv.length > 2) {
+    await getDataAuthenticated(argv[2], argv[3]);
+} else {
+    // stdout is reserved for job replies, so send all console output to stderr
+    globalThis.console = new Console(stderr, stderr);
+    const lines = createInterface({ input: stdin });
+    for await (const line of lines) {
+        if (line.trim()) {
+            handleJob(line);
+        }
+    }
+}
@@ -13,10 +13,9 @@ Each server may receive and spawn multiple jobs. So randomization of job names (
 '''
 
 
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, Response
-from fastapi import status
 from pydantic import BaseModel
 from typing import List, Optional
 from pathlib import Path
@@ -24,17 +23,19 @@ from dataclasses import dataclass
 import tempfile
 import asyncio
 import os
-from collections import defaultdict
+import sys
+from collections import OrderedDict
 from uuid import uuid4 as uuid, UUID
 import json
 import time
 
+from shared_config import load_config, get_origins
 
-CONFIG_FILE = 'config/encryption_agent.json'
-with open(CONFIG_FILE) as fd:
-    _config = json.load(fd)
+
+_config = load_config('encryption_agent')
 
 BASE_DIR = Path(_config['base_dir'])
+BASE_DIR_STR = str(BASE_DIR)
 
 CLIENT_CODE_DIR = BASE_DIR / 'ExternalIO/'
 DATA_DOWNLOAD_DIR = BASE_DIR / 'ExternalIO/DownloadData/'
@@ -58,35 +59,62 @@ class JobContext:
     client_id: int
     code_file: Path
     data_file: Path
+    expire_at: Optional[float] = None
+
+
+class DataFetchError(Exception):
+    pass
 
 
 MAX_CONCURRENT_CLIENT_HANDLES = 100
 client_handle_pool = asyncio.Queue(MAX_CONCURRENT_CLIENT_HANDLES)
 
-client_job_collection = {}
+MAX_TRACKED_JOBS = 1000
+client_job_collection = OrderedDict()
+JOB_RETENTION = 60  # Seconds to keep finished jobs queryable
+REAP_INTERVAL = 5
 
+FETCH_TIMEOUT = 300  # Seconds to wait for the data fetcher to download one file
+FETCHER_RESTART_DELAY = 1
+data_fetcher = None
+fetcher_supervisor = None
+fetch_requests = {}
+job_reaper = None
 
-app = FastAPI()
 
-try:
-    origins = _config['allowed_origins']
-except KeyError:
-    origins = []
-finally:
-    if not origins:
-        origins = ['*']
+app = FastAPI()
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
+    allow_origins=list(get_origins(_config)),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 
+@app.on_event('startup')
+async def start_data_fetcher():
+    global fetcher_supervisor
+    fetcher_supervisor = asyncio.create_task(supervise_data_fetcher())
+
+
+@app.on_event('startup')
+async def start_job_reaper():
+    global job_reaper
+    job_reaper = asyncio.create_task(reap_expired_jobs())
+
+
+@app.on_event('shutdown')
+async def stop_data_fetcher():
+    fetcher_supervisor.cancel()
+    if data_fetcher and data_fetcher.returncode is None:
+        data_fetcher.stdin.close()
+        await data_fetcher.wait()
+
+
 @app.get('/')
-def read_root():
+async def read_root():
     return {'Hello': 'World'}
 
 
@@ -94,7 +122,7 @@ def read_root():
 async def new_client(job: ClientJob, background_tasks: BackgroundTasks):
     global client_job_collection
     client_uuid = str(uuid())
-    client_job_collection[client_uuid] = None
+    track_job(client_uuid, None)
     background_tasks.add_task(handle_new_client, client_uuid, job)
     return client_uuid
 
@@ -104,6 +132,7 @@ async def client_status(client_uuid: str):
     global client_job_collection
     try:
         context = client_job_collection[client_uuid]
+        client_job_collection.move_to_end(client_uuid)
         if context is None:
             raise KeyError()
         if context.proc.returncode is None:
@@ -126,40 +155,122 @@ async def client_status(client_uuid: str):
         # return 404
 
 
+def track_job(client_uuid: str, context: Optional[JobContext]):
+    global client_job_collection
+    client_job_collection[client_uuid] = context
+    client_job_collection.move_to_end(client_uuid)
+    if len(client_job_collection) > MAX_TRACKED_JOBS:
+        client_job_collection.popitem(last=False)
+
+
 async def handle_new_client(client_uuid: UUID, job: ClientJob):
     await client_handle_pool.put(True)
-    code_file = save_client_code(job.client_code)
-    data_file = await fetch_data(job.data_uri)
-    context = await run_client(code_file, data_file, job, client_uuid)
-    await client_handle_pool.get()
+    try:
+        results = await asyncio.gather(
+                save_client_code(job.client_code),
+                fetch_data(job.data_uri),
+                return_exceptions=True)
+        failure = next((r for r in results if isinstance(r, BaseException)), None)
+        if failure is not None:
+            # Don't run the client without its data; drop whatever was already saved
+            for result in results:
+                if isinstance(result, Path):
+                    remove_file(result)
+            client_job_collection.pop(client_uuid, None)
+            print(f"Client job {client_uuid} failed: {failure!r}", file=sys.stderr)
+            return
+        code_file, data_file = results
+        context = await run_client(code_file, data_file, job, client_uuid)
+    finally:
+        client_handle_pool.get_nowait()
     await clean_workspace(context)
 
 
-def save_client_code(client_code: str) -> Path:
-    code_file = tempfile.mktemp(prefix='client_code_', suffix='.py', dir=CLIENT_CODE_DIR)
-    with open(code_file, 'w') as fd:
-        fd.write(client_code)
-    return Path(code_file)
+def _write_temp_file(content: str, **kwargs) -> Path:
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, **kwargs) as fd:
+        fd.write(content)
+    return Path(fd.name)
+
+
+async def save_client_code(client_code: str) -> Path:
+    return await asyncio.to_thread(_write_temp_file, client_code, prefix='client_code_', suffix='.py', dir=CLIENT_CODE_DIR)
 
 
 async def fetch_data(data_uri: str) -> Path:
-    data_file = tempfile.mktemp(prefix='data_', suffix='.dat', dir=DATA_DOWNLOAD_DIR)
-    # cmd = ['wget', str(data_uri), '-O', data_file]
-    cmd = ['env', 'NODE_ENV=encryption_agent', './data_fetcher.js', str(data_uri), str(data_file)]
-    proc = await asyncio.create_subprocess_exec(*cmd)
-    await proc.communicate()
+    data_file = await asyncio.to_thread(_write_temp_file, '', prefix='data_', suffix='.dat', dir=DATA_DOWNLOAD_DIR)
+    request_id = str(uuid())
+    reply = asyncio.get_running_loop().create_future()
+    fetch_requests[request_id] = reply
+    request = {'id': request_id, 'uri': str(data_uri), 'out': str(data_file)}
+    try:
+        if data_fetcher is None or data_fetcher.returncode is not None:
+            raise ConnectionResetError("data_fetcher.js is not running")
+        data_fetcher.stdin.write(json.dumps(request).encode() + b'\n')
+        await data_fetcher.stdin.drain()
+        result = await asyncio.wait_for(asyncio.shield(reply), FETCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        # The fetcher may still be writing the file, so only remove it once the fetcher is done with it
+        reply.add_done_callback(lambda _: remove_file(data_file))
+        raise DataFetchError(f"Timed out fetching {data_uri}")
+    except ConnectionError as e:
+        fetch_requests.pop(request_id, None)
+        remove_file(data_file)
+        raise DataFetchError(f"Failed to fetch {data_uri}: {e!r}") from e
+    if not result.get('ok'):
+        remove_file(data_file)
+        raise DataFetchError(f"Failed to fetch {data_uri}")
     return data_file
 
 
+def remove_file(file_name: Path):
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+
+async def supervise_data_fetcher():
+    global data_fetcher
+    # The data fetcher is long-lived and receives jobs over stdin; restart it whenever it exits
+    cmd = ['env', 'NODE_ENV=encryption_agent', './data_fetcher.js']
+    while True:
+        data_fetcher = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        await dispatch_fetcher_replies(data_fetcher)
+        return_code = await data_fetcher.wait()
+        # Release everyone still waiting for the exited fetcher
+        for future in fetch_requests.values():
+            if not future.done():
+                future.set_result({'ok': False})
+        fetch_requests.clear()
+        print(f"data_fetcher.js exited with {return_code}, restarting", file=sys.stderr)
+        await asyncio.sleep(FETCHER_RESTART_DELAY)
+
+
+async def dispatch_fetcher_replies(fetcher: asyncio.subprocess.Process):
+    while True:
+        try:
+            line = await fetcher.stdout.readline()
+        except ValueError:  # Line longer than the stream limit
+            continue
+        if not line:
+            break
+        try:
+            reply = json.loads(line)
+            future = fetch_requests.pop(reply['id'], None)
+        except (ValueError, TypeError, KeyError):
+            print(f"Ignoring unexpected data_fetcher.js output: {line!r}", file=sys.stderr)
+            continue
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+
 async def run_client(code_file: Path, data_file: Path, job: ClientJob, client_uuid: str):
     global client_job_collection
-    cmd = ['python', code_file, job.client_id, data_file, ','.join(job.player_servers), job.data_size]
+    cmd = ['python', str(code_file), str(job.client_id), str(data_file), ','.join(job.player_servers), str(job.data_size)]
     cmd.extend(job.extra_args)
-    cmd = [str(e) for e in cmd]
-    command_text = f"cd {BASE_DIR};" + ' '.join(cmd)
-    proc = await asyncio.create_subprocess_shell(command_text, stdout=asyncio.subprocess.PIPE)
+    proc = await asyncio.create_subprocess_exec(*cmd, cwd=BASE_DIR_STR, stdout=asyncio.subprocess.PIPE)
     context = JobContext(client_uuid, proc, job.computation_id, job.client_id, code_file, data_file)
-    client_job_collection[client_uuid] = context
+    track_job(client_uuid, context)
     return context
 
 
@@ -168,5 +279,14 @@ async def clean_workspace(job_context: JobContext):
     await job_context.proc.wait()
     os.remove(job_context.code_file)
     os.remove(job_context.data_file)
-    await asyncio.sleep(60)  # For demonstration, wait 60 seconds before removing the jobs
-    del client_job_collection[job_context.client_uuid]
+    job_context.expire_at = time.monotonic() + JOB_RETENTION  # For demonstration, keep the job for a while before removing it
+
+
+async def reap_expired_jobs():
+    global client_job_collection
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        now = time.monotonic()
+        for client_uuid, context in list(client_job_collection.items()):
+            if context and context.expire_at and context.expire_at <= now:
+                del client_job_collection[client_uuid]
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Configuration helpers shared by the encryption agent and the computation agent.
+'''
+
+from typing import Tuple
+import json
+
+
+def load_config(name: str) -> dict:
+    with open(f'config/{name}.json') as fd:
+        return json.load(fd)
+
+
+def get_origins(config: dict) -> Tuple[str, ...]:
+    origins = tuple(config.get('allowed_origins') or ())
+    # CORSMiddleware short-circuits on a lone wildcard, so don't list specific hosts alongside it
+    if not origins or '*' in origins:
+        origins = ('*',)
+    return origins